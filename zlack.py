@@ -16,7 +16,7 @@ prefs_file = '.zlack-prefs'
 
 zlackdir = os.environ.get('ZLACK_DIR')
 if not zlackdir:
-    zlackdir = os.environ.get('HOME')
+    zlackdir = os.path.expanduser('~')
 
 token_path = os.path.join(zlackdir, token_file)
 prefs_path = os.path.join(zlackdir, prefs_file)
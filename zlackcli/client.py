@@ -3,13 +3,9 @@ import os
 import platform
 import time
 import traceback
-from collections import OrderedDict
-import json
 import asyncio
-import aiohttp
-import aiohttp.web
 
-from .teamdat import Host
+from .teamdat import Host, json_loads, json_dumps
 from .prefs import Prefs
 from .ui import UI
 from .slackmod import SlackProtocol
@@ -40,7 +36,9 @@ class ZlackClient:
         self.protocols = [ SlackProtocol(self), MattermProtocol(self) ]
         self.protocolmap = { pro.key:pro for pro in self.protocols }
             
-        self.teams = OrderedDict()
+        self.teams = {}
+        # Maps lowercased team names and aliases to Hosts.
+        self.teams_by_name = {}
         self.auth_in_progress = False
 
         self.ui.find_commands(self.protocols)
@@ -93,16 +91,38 @@ class ZlackClient:
         return None.
         """
         return self.teams.get(key)
+
+    def index_teams(self):
+        """Rebuild self.teams_by_name, which is used to look up teams by
+        exact name, alias, or ID. Call this whenever a team is added or
+        its aliases change.
+        If two teams share a name, the first one wins. (This matches
+        what ParseMatch.list_best() would pick.) IDs are added last, so
+        they never shadow a name or alias.
+        """
+        index = {}
+        for team in self.teams.values():
+            index.setdefault(team.team_name.lower(), team)
+            aliases = team.get_aliases()
+            if aliases:
+                for val in aliases:
+                    index.setdefault(val.lower(), team)
+        for team in self.teams.values():
+            index.setdefault(team.id.lower(), team)
+        self.teams_by_name = index
     
     def read_teams(self):
         """Read the current token list from ~/.zlack-tokens.
         Fills out self.teams with Host objects.
         """
         try:
-            fl = open(self.tokenpath)
-            dat = json.load(fl, object_pairs_hook=OrderedDict)
+            fl = open(self.tokenpath, 'rb')
+            dat = json_loads(fl.read())
             fl.close()
-        except:
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as ex:
+            self.print_exception(ex, 'Reading tokens')
             return
         for teammap in dat:
             try:
@@ -116,20 +136,32 @@ class ZlackClient:
 
     def write_teams(self):
         """Write out the current team list to ~/.zlack-tokens.
-        (Always chmods the file to 0700, for privacy.)
+        (The file is created with mode 0600, for privacy. We write a
+        temporary file and then rename it into place, so a crash can't
+        leave a half-written token file.)
         """
         # We use the origmap object which we saved when loading in the Host.
         teamlist = []
         for team in self.teams.values():
             teamlist.append(team.origmap)
             
+        tmppath = self.tokenpath + '.tmp'
         try:
-            fl = open(self.tokenpath, 'w')
-            json.dump(teamlist, fl, indent=1)
-            fl.write('\n')
-            fl.close()
-            os.chmod(self.tokenpath, 0o700)
+            dat = (json_dumps(teamlist, indent=True) + '\n').encode()
+            # Create the file private, rather than chmodding it after
+            # the tokens are written.
+            fd = os.open(tmppath, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as fl:
+                fl.write(dat)
+                fl.flush()
+                os.fsync(fd)
+            os.replace(tmppath, self.tokenpath)
         except Exception as ex:
+            # Don't leave a stray copy of the tokens lying around.
+            try:
+                os.unlink(tmppath)
+            except OSError:
+                pass
             self.print_exception(ex, 'Writing tokens')
     
     async def open(self):
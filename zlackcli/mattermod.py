@@ -4,16 +4,15 @@ import os.path
 import tempfile
 import re
 import json
-from collections import OrderedDict
 import collections.abc
-import random
+import secrets
 import urllib.parse
 import asyncio
 import aiohttp
-import aiohttp.web
 import websockets
 
 from .teamdat import Protocol, ProtoUI, Host, Channel, User
+from .teamdat import json_loads, json_dumps
 from .parsematch import ParseMatch
 from .ui import uicommand, ArgException
 
@@ -26,6 +25,7 @@ class MattermProtocol(Protocol):
 
     base_api_url = 'https://MHOST'
     base_auth_url = 'https://MHOST/oauth/authorize'
+    base_auth_url_parts = urllib.parse.urlparse(base_auth_url)
     
     def __init__(self, client):
         super().__init__(client)
@@ -101,7 +101,7 @@ class MattermProtocol(Protocol):
         async with httpfunc(url, headers=headers, data=data) as resp:
             try:
                 # Disable content-type check; Mattermost seems to send text/plain for errors, even JSON errors
-                return await resp.json(content_type=None)
+                return await resp.json(content_type=None, loads=json_loads)
             except json.JSONDecodeError:
                 val = await resp.text()
                 raise Exception('Non-JSON response: %s' % (val[:80],))
@@ -191,7 +191,9 @@ class MattermProtocol(Protocol):
         future = self.client.evloop.create_future()
 
         # Bring up a local web server to wait for the redirect callback.
-        # When we get it, the future will be set.
+        # When we get it, the future will be set. (The web server module
+        # is only needed here, so we don't import it at startup.)
+        import aiohttp.web
         server = aiohttp.web.Server(self.construct_auth_handler(future, statecheck))
         sockserv = await self.client.evloop.create_server(server, 'localhost', self.client.opts.auth_port)
 
@@ -237,7 +239,7 @@ class MattermProtocol(Protocol):
         """
 
         # Create a new entry for ~/.zlack-tokens.
-        teammap = OrderedDict()
+        teammap = {}
         teammap['_protocol'] = MattermProtocol.key
         teammap['host'] = mhost
         teammap['access_token'] = access_token
@@ -303,20 +305,16 @@ class MattermProtocol(Protocol):
           back.
         """
         redirecturl = 'http://localhost:%d/' % (authport,)
-        statecheck = 'state_%d' % (random.randrange(1000000),)
+        statecheck = 'state_' + secrets.token_urlsafe(16)
 
-        authurl = self.base_auth_url.replace('MHOST', mhost)
-        
         params = [
             ('client_id', clientid),
             ('response_type', 'code'),
             ('redirect_uri', redirecturl),
             ('state', statecheck),
         ]
-        queryls = [ '%s=%s' % (key, urllib.parse.quote(val)) for (key, val) in params ]
-        tup = list(urllib.parse.urlparse(authurl))
-        tup[1] = mhost
-        tup[4] = '&'.join(queryls)
+        query = urllib.parse.urlencode(params, safe='/', quote_via=urllib.parse.quote)
+        tup = self.base_auth_url_parts._replace(netloc=mhost, query=query)
         authurl = urllib.parse.urlunparse(tup)
         
         return (authurl, redirecturl, statecheck)
@@ -346,9 +344,10 @@ class MattermUI(ProtoUI):
     def encode_message(self, team, val):
         """Encode a human-typed message into standard Mattermost form.
         """
-        val = val.replace('&', '&amp;')
-        val = val.replace('<', '&lt;')
-        val = val.replace('>', '&gt;')
+        if '&' in val or '<' in val or '>' in val:
+            val = val.replace('&', '&amp;')
+            val = val.replace('<', '&lt;')
+            val = val.replace('>', '&gt;')
         return val
     
     def handle_message(self, msg, team):
@@ -376,8 +375,8 @@ class MattermUI(ProtoUI):
             # subteamid is empty for DM messages
             subteam = team.subteams.get(subteamid)
             try:
-                post = json.loads(data.get('post', ''))
-            except:
+                post = json_loads(data.get('post', ''))
+            except (ValueError, TypeError):
                 post = {}
             userid = post.get('user_id', '')
             chanid = post.get('channel_id', '')
@@ -396,7 +395,7 @@ class MattermUI(ProtoUI):
                         self.client.note_file_data(team, filid, fil)
             text = self.decode_message(team, post.get('message'), files=files)
             colon = (':' if subtype != 'me' else '')
-            val = '[%s/%s] %s%s %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), self.ui.user_name(team, userid), colon, text)
+            val = '%s %s%s %s' % (self.ui.channel_prefix(team, chanid), self.ui.user_name(team, userid), colon, text)
             self.print(val)
             self.ui.lastchannel = (team.key, chanid)
             return
@@ -404,8 +403,8 @@ class MattermUI(ProtoUI):
         if typ == 'post_edited' or typ == 'post_deleted':
             data = msg.get('data', {})
             try:
-                post = json.loads(data.get('post', ''))
-            except:
+                post = json_loads(data.get('post', ''))
+            except (ValueError, TypeError):
                 post = {}
             userid = post.get('user_id', '')
             chan = team.channels_by_realid.get(post.get('channel_id', ''))
@@ -424,7 +423,7 @@ class MattermUI(ProtoUI):
             text = self.decode_message(team, post.get('message'), files=files)
             colon = (':' if subtype != 'me' else '')
             postact = ('edit' if typ == 'post_edited' else 'del')
-            val = '[%s/%s] (%s) %s%s %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), postact, self.ui.user_name(team, userid), colon, text)
+            val = '%s (%s) %s%s %s' % (self.ui.channel_prefix(team, chanid), postact, self.ui.user_name(team, userid), colon, text)
             self.print(val)
             self.ui.lastchannel = (team.key, chanid)
             return
@@ -589,7 +588,7 @@ class MattermHost(Host):
         self.refresh_token = map.get('refresh_token', None)
         self.expires_in = map.get('expires_in', None)
         self.updated_at = map.get('updated_at', None)
-        self.origmap = map  # save the OrderedDict for writing out
+        self.origmap = map  # save the map for writing out
 
         # The modularity here is wrong.
         self.nameparser = ParseMatch(self.team_name)
@@ -602,6 +601,7 @@ class MattermHost(Host):
         self.channels = {}
         self.channels_by_name = {}
         self.channels_by_realid = {}
+        self.channels_by_tail = {}
         self.muted_channels = set()
         
         # The last channel (id) we spoke on in this team. (That is, we
@@ -711,7 +711,7 @@ class MattermHost(Host):
         async with httpfunc(url, json=data) as resp:
             try:
                 # Disable content-type check; Mattermost seems to send text/plain for errors, even JSON errors
-                res = await resp.json(content_type=None)
+                res = await resp.json(content_type=None, loads=json_loads)
                 self.client.ui.note_receive_message(res, self)
                 return res
             except json.JSONDecodeError:
@@ -787,9 +787,7 @@ class MattermHost(Host):
         with that value, return it (and remove it from our pool of sent
         messages.)
         """
-        if val in self.msg_in_flight:
-            return self.msg_in_flight.pop(val)
-        return None
+        return self.msg_in_flight.pop(val, None)
         
     def rtm_connected(self):
         """Check whether the RTM websocket is open.
@@ -918,7 +916,7 @@ class MattermHost(Host):
                 
             obj = None
             try:
-                obj = json.loads(msg)
+                obj = json_loads(msg)
             except Exception as ex:
                 self.print_exception(ex, 'JSON decode')
                 continue
@@ -950,7 +948,7 @@ class MattermHost(Host):
             self.msg_in_flight[msg['seq']] = msg
         self.client.ui.note_send_message(msg, self)
         try:
-            await self.rtm_socket.send(json.dumps(msg))
+            await self.rtm_socket.send(json_dumps(msg))
         except websockets.ConnectionClosed as ex:
             self.print('<ConnectionClosed: %s (%s "%s")>' % (self.short_name(), ex.code, ex.reason,))
             self.handle_disconnect()
@@ -973,6 +971,8 @@ class MattermHost(Host):
         if not order:
             return
         
+        # Collect the lines and print them all at once.
+        lines = []
         for msgid in reversed(order):
             post = map.get(msgid)
             if not post:
@@ -995,8 +995,10 @@ class MattermHost(Host):
                 continue
             text = self.protocol.protoui.decode_message(self, post.get('message'), files=files)
             colon = (':' if subtype != 'me' else '')
-            val = '[%s/%s] (%s) %s%s %s' % (ui.team_name(self), ui.channel_name(self, chanid), ts, ui.user_name(self, userid), colon, text)
-            self.print(val)
+            val = '%s (%s) %s%s %s' % (ui.channel_prefix(self, chanid), ts, ui.user_name(self, userid), colon, text)
+            lines.append(val)
+        if lines:
+            self.print('\n'.join(lines))
         
     async def load_connection_data(self):
         """Load all the information we need for a connection: the channel
@@ -1009,6 +1011,7 @@ class MattermHost(Host):
         self.channels.clear()
         self.channels_by_name.clear()
         self.channels_by_realid.clear()
+        self.channels_by_tail = {}
         self.users.clear()
         self.users_by_display_name.clear();
 
@@ -1020,12 +1023,15 @@ class MattermHost(Host):
             res = await self.api_call_check('users', __page=page)
             if not res:
                 break
+            users = self.users
+            users_by_display_name = self.users_by_display_name
             for user in res:
                 userid = user['id']
                 username = user['username']
                 userrealname = (user.get('first_name') + ' ' + user.get('last_name')).strip()
-                self.users[userid] = MattermUser(self, userid, username, userrealname)
-                self.users_by_display_name[username] = self.users[userid]
+                userobj = MattermUser(self, userid, username, userrealname)
+                users[userid] = userobj
+                users_by_display_name[username] = userobj
             page += 1
             
         #self.client.print('Users for %s: %s' % (self, list(self.users.values()),))
@@ -1099,6 +1105,8 @@ class MattermHost(Host):
                     self.channels_by_name[channame] = chan
                     
                 page += 1
+
+        self.index_channels()
             
         #self.client.print('Channels for %s: %s' % (self, self.channels,))
 
@@ -1129,6 +1137,8 @@ class MattermSubteam:
 class MattermChannel(Channel):
     """Simple object representing one channel in a group.
     """
+    __slots__ = ('subteam', 'realid', 'realname', 'nameparselist')
+    
     def __init__(self, team, subteam, id, name, private=False, member=True, im=None):
         if subteam is None and im is None:
             raise Exception('only DM channels should be subteamless')
@@ -1182,6 +1192,8 @@ class MattermChannel(Channel):
 class MattermUser(User):
     """Simple object representing one user in a group.
     """
+    __slots__ = ()
+    
     def __init__(self, team, id, name, real_name):
         self.team = team
         self.client = team.client
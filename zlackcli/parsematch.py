@@ -87,7 +87,7 @@ class ParseMatch:
         
         if self.id == text:
             return Res.EXACT
-        if self.aliases and self.id in self.aliases:
+        if self.aliases and text in self.aliases:
             return Res.EXACT
         
         if text:
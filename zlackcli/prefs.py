@@ -1,6 +1,5 @@
 import os
 import json
-from collections import OrderedDict
 
 
 class Prefs:
@@ -12,22 +11,21 @@ class Prefs:
         self.write_handle = None
         self.map = self.read_file()
         if 'teams' not in self.map:
-            self.map['teams'] = OrderedDict()
+            self.map['teams'] = {}
 
     def read_file(self):
         try:
             fl = open(self.path)
-            dat = json.load(fl, object_pairs_hook=OrderedDict)
+            dat = json.load(fl)
             fl.close()
         except:
-            dat = OrderedDict()
+            dat = {}
         return dat
 
     def write_file(self):
         try:
             fl = open(self.path, 'w')
-            json.dump(self.map, fl, indent=1)
-            fl.write('\n')
+            fl.write(json.dumps(self.map, indent=1) + '\n')
             fl.close()
         except Exception as ex:
             self.client.print_exception(ex, 'Writing prefs')
@@ -52,7 +50,7 @@ class Prefs:
             team = team.key
         map = self.map['teams'].get(team)
         if map is None:
-            map = OrderedDict()
+            map = {}
             self.map['teams'][team] = map
         map[key] = val
         self.mark_dirty()
@@ -80,15 +78,15 @@ class Prefs:
             chan = chan.id
         map = self.map['teams'].get(team)
         if map is None:
-            map = OrderedDict()
+            map = {}
             self.map['teams'][team] = map
         chanmap = map.get('channels')
         if chanmap is None:
-            chanmap = OrderedDict()
+            chanmap = {}
             map['channels'] = chanmap
         submap = chanmap.get(chan)
         if submap is None:
-            submap = OrderedDict()
+            submap = {}
             chanmap[chan] = submap
         submap[key] = val
         self.mark_dirty()
@@ -2,16 +2,15 @@ import sys
 import time
 import os
 import re
-import json
-from collections import OrderedDict
-import random
+import secrets
+import functools
 import urllib.parse
 import asyncio
 import aiohttp
-import aiohttp.web
 import websockets
 
 from .teamdat import Protocol, ProtoUI, Host, Channel, User
+from .teamdat import json_loads, json_dumps
 from .parsematch import ParseMatch
 
 class SlackProtocol(Protocol):
@@ -23,6 +22,7 @@ class SlackProtocol(Protocol):
 
     api_url = 'https://slack.com/api'
     auth_url = 'https://slack.com/oauth/authorize'
+    auth_url_parts = urllib.parse.urlparse(auth_url)
     
     def __init__(self, client):
         super().__init__(client)
@@ -32,6 +32,7 @@ class SlackProtocol(Protocol):
 
         self.client_id = client.opts.slack_client_id
         self.client_secret = client.opts.slack_client_secret
+        self.connector = None
         self.session = None
 
         self.authtask = None
@@ -44,7 +45,11 @@ class SlackProtocol(Protocol):
         headers = {
             'user-agent': self.client.get_useragent(),
         }
-        self.session = aiohttp.ClientSession(headers=headers)
+        # Every Slack API call goes to slack.com, so the protocol session
+        # and all the team sessions share one connection pool. That way
+        # a new team (or a new call) can reuse an open TLS connection.
+        self.connector = aiohttp.TCPConnector()
+        self.session = aiohttp.ClientSession(headers=headers, connector=self.connector, connector_owner=False)
             
         if self.teams:
             (done, pending) = await asyncio.wait([ self.client.evloop.create_task(team.open()) for team in self.teams.values() ])
@@ -74,6 +79,10 @@ class SlackProtocol(Protocol):
             await self.session.close()
             self.session = None
             
+        if self.connector:
+            await self.connector.close()
+            self.connector = None
+            
     async def api_call(self, method, **kwargs):
         """Make a Slack API call. If kwargs contains a "token"
         field, this is used; otherwise, the call is unauthenticated.
@@ -93,7 +102,7 @@ class SlackProtocol(Protocol):
             data[key] = val
 
         async with self.session.post(url, headers=headers, data=data) as resp:
-            return await resp.json()
+            return await resp.json(loads=json_loads)
 
     async def wakeloop_async(self):
         """This task runs in the background and watches the system clock.
@@ -176,7 +185,9 @@ class SlackProtocol(Protocol):
         future = self.client.evloop.create_future()
 
         # Bring up a local web server to wait for the redirect callback.
-        # When we get it, the future will be set.
+        # When we get it, the future will be set. (The web server module
+        # is only needed here, so we don't import it at startup.)
+        import aiohttp.web
         server = aiohttp.web.Server(self.construct_auth_handler(future, statecheck))
         sockserv = await self.client.evloop.create_server(server, 'localhost', self.client.opts.auth_port)
 
@@ -217,7 +228,7 @@ class SlackProtocol(Protocol):
             return
 
         # Got the permanent token. Create a new entry for ~/.zlack-tokens.
-        teammap = OrderedDict()
+        teammap = {}
         teammap['_protocol'] = SlackProtocol.key
         for key in ('team_id', 'team_name', 'user_id', 'scope', 'access_token'):
             if key in res:
@@ -253,7 +264,7 @@ class SlackProtocol(Protocol):
           back.
         """
         redirecturl = 'http://localhost:%d/' % (authport,)
-        statecheck = 'state_%d' % (random.randrange(1000000),)
+        statecheck = 'state_' + secrets.token_urlsafe(16)
     
         params = [
             ('client_id', clientid),
@@ -261,9 +272,8 @@ class SlackProtocol(Protocol):
             ('redirect_uri', redirecturl),
             ('state', statecheck),
         ]
-        queryls = [ '%s=%s' % (key, urllib.parse.quote(val)) for (key, val) in params ]
-        tup = list(urllib.parse.urlparse(self.auth_url))
-        tup[4] = '&'.join(queryls)
+        query = urllib.parse.urlencode(params, safe='/', quote_via=urllib.parse.quote)
+        tup = self.auth_url_parts._replace(query=query)
         slackurl = urllib.parse.urlunparse(tup)
         
         return (slackurl, redirecturl, statecheck)
@@ -273,10 +283,10 @@ class SlackUI(ProtoUI):
     output) and the protocol (with its protocol-specific messages).
     """
     
-    pat_user_id = re.compile('@([a-z0-9._]+)', flags=re.IGNORECASE)
-    pat_channel_id = re.compile('#([a-z0-9_-]+)', flags=re.IGNORECASE)
-    pat_encoded_user_id = re.compile('<@([a-z0-9_]+)>', flags=re.IGNORECASE)
-    pat_encoded_channel_id = re.compile('<#([a-z0-9_]+)([|][a-z0-9_-]*)?>', flags=re.IGNORECASE)
+    pat_user_id = re.compile('@([a-zA-Z0-9._]+)')
+    pat_channel_id = re.compile('#([a-zA-Z0-9_-]+)')
+    pat_encoded_user_id = re.compile('<@([a-zA-Z0-9_]+)>')
+    pat_encoded_channel_id = re.compile('<#([a-zA-Z0-9_]+)([|][a-zA-Z0-9_-]*)?>')
 
     def send_message(self, text, team, chanid):
         """Send a message to the given team and channel.
@@ -288,13 +298,17 @@ class SlackUI(ProtoUI):
     def encode_message(self, team, val):
         """Encode a human-typed message into standard Slack form.
         """
-        val = val.replace('&', '&amp;')
-        val = val.replace('<', '&lt;')
-        val = val.replace('>', '&gt;')
+        if '&' in val or '<' in val or '>' in val:
+            val = val.replace('&', '&amp;')
+            val = val.replace('<', '&lt;')
+            val = val.replace('>', '&gt;')
         # We try to locate @displayname references and convert them to
-        # <@USERID>.
-        val = self.pat_user_id.sub(lambda match:self.encode_exact_user_id(team, match), val)
-        val = self.pat_channel_id.sub(lambda match:self.encode_exact_channel_id(team, match), val)
+        # <@USERID>. (Most lines have none, so check before running the
+        # regex.)
+        if '@' in val:
+            val = self.pat_user_id.sub(functools.partial(self.encode_exact_user_id, team), val)
+        if '#' in val:
+            val = self.pat_channel_id.sub(functools.partial(self.encode_exact_channel_id, team), val)
         return val
     
     def encode_exact_user_id(self, team, match):
@@ -302,22 +316,32 @@ class SlackUI(ProtoUI):
         pat_user_id, return a <@USERID> substitution. If the match doesn't
         exactly match a user display name, we return the original string.    
         """
-        orig = match.group(0)  # '@name'
-        val = match.group(1)   # 'name'
-        if val not in team.users_by_display_name:
-            return orig
-        return '<@' + team.users_by_display_name[val].id + '>'
+        user = team.users_by_display_name.get(match.group(1))  # 'name'
+        if user is None:
+            return match.group(0)  # '@name'
+        return '<@' + user.id + '>'
     
     def encode_exact_channel_id(self, team, match):
         """Utility function used by encode_message. Given a match object from
         pat_channel_id, return a <#CHANID> substitution. If the match doesn't
         exactly match a channel name, we return the original string.    
         """
-        orig = match.group(0)  # '#channel'
-        val = match.group(1)   # 'channel'
-        if val not in team.channels_by_name:
-            return orig
-        return '<#' + team.channels_by_name[val].id + '>'
+        chan = team.channels_by_name.get(match.group(1))  # 'channel'
+        if chan is None:
+            return match.group(0)  # '#channel'
+        return '<#' + chan.id + '>'
+    
+    def decode_user_id(self, team, match):
+        """Utility function used by decode_message. Given a match object
+        from pat_encoded_user_id, return an @name substitution.
+        """
+        return '@' + self.ui.user_name(team, match.group(1))
+    
+    def decode_channel_id(self, team, match):
+        """Utility function used by decode_message. Given a match object
+        from pat_encoded_channel_id, return a #channel substitution.
+        """
+        return '#' + self.ui.channel_name(team, match.group(1)) + (match.group(2) or '')
 
     def handle_message(self, msg, team):
         """Handle one message received from the Slack server (over the
@@ -343,7 +367,7 @@ class SlackUI(ProtoUI):
                 chanid = origmsg.get('channel', '')
                 userid = origmsg.get('user', '')
                 text = self.decode_message(team, msg.get('text'), attachments=msg.get('attachments'), files=msg.get('files'))
-                val = '[%s/%s] %s: %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), self.ui.user_name(team, userid), text)
+                val = '%s %s: %s' % (self.ui.channel_prefix(team, chanid), self.ui.user_name(team, userid), text)
                 self.print(val)
             return
         
@@ -359,25 +383,25 @@ class SlackUI(ProtoUI):
             if chanid in team.muted_channels:
                 return
             if subtype == 'message_deleted':
-                userid = msg.get('previous_message').get('user', '')
-                oldtext = msg.get('previous_message').get('text')
-                oldtext = self.decode_message(team, oldtext)
-                val = '[%s/%s] (del) %s: %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), self.ui.user_name(team, userid), oldtext)
+                prevmsg = msg.get('previous_message') or {}
+                userid = prevmsg.get('user', '')
+                oldtext = self.decode_message(team, prevmsg.get('text'))
+                val = '%s (del) %s: %s' % (self.ui.channel_prefix(team, chanid), self.ui.user_name(team, userid), oldtext)
                 self.print(val)
                 return
             if subtype == 'message_changed':
                 oldtext = ''
-                if 'previous_message' in msg:
-                    oldtext = msg.get('previous_message').get('text')
-                    oldtext = self.decode_message(team, oldtext)
-                userid = msg.get('message').get('user', '')
-                newtext = msg.get('message').get('text')
-                newtext = self.decode_message(team, newtext, attachments=msg.get('attachments'), files=msg.get('files'))
+                prevmsg = msg.get('previous_message')
+                if prevmsg is not None:
+                    oldtext = self.decode_message(team, prevmsg.get('text'))
+                newmsg = msg.get('message') or {}
+                userid = newmsg.get('user', '')
+                newtext = self.decode_message(team, newmsg.get('text'), attachments=msg.get('attachments'), files=msg.get('files'))
                 if oldtext == newtext:
                     # Most likely this is a change to attachments, caused by Slack creating an image preview. Ignore.
                     return
                 text = oldtext + '\n -> ' + newtext
-                val = '[%s/%s] (edit) %s: %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), self.ui.user_name(team, userid), text)
+                val = '%s (edit) %s: %s' % (self.ui.channel_prefix(team, chanid), self.ui.user_name(team, userid), text)
                 self.print(val)
                 self.ui.lastchannel = (team.key, chanid)
                 return
@@ -388,7 +412,7 @@ class SlackUI(ProtoUI):
             text = self.decode_message(team, msg.get('text'), attachments=msg.get('attachments'), files=msg.get('files'))
             subtypeflag = (' (%s)'%(subtype,) if subtype else '')
             colon = (':' if subtype != 'me_message' else '')
-            val = '[%s/%s]%s %s%s %s' % (self.ui.team_name(team), self.ui.channel_name(team, chanid), subtypeflag, self.ui.user_name(team, userid), colon, text)
+            val = '%s%s %s%s %s' % (self.ui.channel_prefix(team, chanid), subtypeflag, self.ui.user_name(team, userid), colon, text)
             self.print(val)
             self.ui.lastchannel = (team.key, chanid)
             return
@@ -405,8 +429,10 @@ class SlackUI(ProtoUI):
         if val is None:
             val = ''
         else:
-            val = self.pat_encoded_user_id.sub(lambda match:'@'+self.ui.user_name(team, match.group(1)), val)
-            val = self.pat_encoded_channel_id.sub(lambda match:'#'+self.ui.channel_name(team, match.group(1))+(match.group(2) if match.group(2) else ''), val)
+            if '<@' in val:
+                val = self.pat_encoded_user_id.sub(functools.partial(self.decode_user_id, team), val)
+            if '<#' in val:
+                val = self.pat_encoded_channel_id.sub(functools.partial(self.decode_channel_id, team), val)
             # We could translate <URL> and <URL|SLUG> here, but those look fine as is
             if '\n' in val:
                 val = val.replace('\n', '\n... ')
@@ -471,7 +497,7 @@ class SlackTeam(Host):
         self.team_name = map.get('team_name', '???')
         self.user_id = map['user_id']
         self.access_token = map['access_token']
-        self.origmap = map  # save the OrderedDict for writing out
+        self.origmap = map  # save the map for writing out
 
         # The modularity here is wrong.
         self.nameparser = ParseMatch(self.team_name)
@@ -481,7 +507,12 @@ class SlackTeam(Host):
         self.users_by_display_name = {}
         self.channels = {}
         self.channels_by_name = {}
-        self.muted_channels = set()
+        self.channels_by_tail = {}
+        # Replaced wholesale (never modified) when the prefs are loaded.
+        self.muted_channels = frozenset()
+        # Substrings which identify muted-channel messages in a raw RTM
+        # frame. (See is_muted_frame().)
+        self.muted_needles = ()
         
         # The last channel (id) we spoke on in this team. (That is, we
         # set this when ui.curchannel is set. We use this when switching
@@ -505,7 +536,7 @@ class SlackTeam(Host):
             'user-agent': self.client.get_useragent(),
             'Authorization': 'Bearer '+self.access_token,
         }
-        self.session = aiohttp.ClientSession(headers=headers)
+        self.session = aiohttp.ClientSession(headers=headers, connector=self.protocol.connector, connector_owner=False)
 
         await self.load_connection_data()
 
@@ -544,7 +575,7 @@ class SlackTeam(Host):
         self.client.ui.note_send_message(data, self)
         
         async with self.session.post(url, data=data) as resp:
-            res = await resp.json()
+            res = await resp.json(loads=json_loads)
             self.client.ui.note_receive_message(res, self)
             return res
     
@@ -586,9 +617,7 @@ class SlackTeam(Host):
         with that value, return it (and remove it from our pool of sent
         messages.)
         """
-        if val in self.msg_in_flight:
-            return self.msg_in_flight.pop(val)
-        return None
+        return self.msg_in_flight.pop(val, None)
         
     def rtm_connected(self):
         """Check whether the RTM websocket is open.
@@ -711,10 +740,12 @@ class SlackTeam(Host):
                 self.print_exception(ex, 'RTM readloop')
             if not msg:
                 continue
+            if self.muted_needles and not self.client.ui.debug_messages and self.is_muted_frame(msg):
+                continue
                 
             obj = None
             try:
-                obj = json.loads(msg)
+                obj = json_loads(msg)
             except Exception as ex:
                 self.print_exception(ex, 'JSON decode')
                 continue
@@ -724,6 +755,30 @@ class SlackTeam(Host):
             except Exception as ex:
                 self.print_exception(ex, 'Message handler')
         
+    def is_muted_frame(self, msg):
+        """Check whether a raw RTM frame is a message on a muted channel,
+        so that the readloop can drop it without decoding it.
+        This is a plain substring test on the JSON text, so it only
+        accepts the simple shape: a frame with a single "channel" key.
+        Events which nest a message under "item" (reactions, pins,
+        stars) are not matched, and neither are frames with "files",
+        since handle_message() notes those even on muted channels.
+        Anything that doesn't fit (or if the server changes its spacing)
+        is decoded and handled as usual.
+        """
+        if not isinstance(msg, str):
+            return False
+        if '"type":"message"' not in msg or '"reply_to"' in msg:
+            return False
+        if '"item":' in msg or '"files":' in msg:
+            return False
+        if msg.count('"channel":') != 1:
+            return False
+        for needle in self.muted_needles:
+            if needle in msg:
+                return True
+        return False
+        
     def rtm_send(self, msg):
         """Send a message via the RTM websocket.
         (Fire-and-forget call.)
@@ -746,7 +801,7 @@ class SlackTeam(Host):
             self.msg_in_flight[msg['id']] = msg
         self.client.ui.note_send_message(msg, self)
         try:
-            await self.rtm_socket.send(json.dumps(msg))
+            await self.rtm_socket.send(json_dumps(msg))
         except websockets.ConnectionClosed as ex:
             self.print('<ConnectionClosed: %s (%s "%s")>' % (self.short_name(), ex.code, ex.reason,))
             self.handle_disconnect()
@@ -758,11 +813,14 @@ class SlackTeam(Host):
         """
         ui = self.client.ui
         timestamp = str(int(time.time()) - interval)
+        prefix = ui.channel_prefix(self, chanid)
         cursor = None
         while True:
             res = await self.api_call_check('conversations.history', channel=chanid, oldest=timestamp, cursor=cursor)
             if not res:
                 break
+            # Collect each page's lines and print them all at once.
+            lines = []
             for msg in reversed(res.get('messages')):
                 userid = msg.get('user', '')
                 subtype = msg.get('subtype', '')
@@ -771,8 +829,10 @@ class SlackTeam(Host):
                 ts = msg.get('ts')
                 ts = ui.short_timestamp(ts)
                 text = self.protocol.protoui.decode_message(self, msg.get('text'), attachments=msg.get('attachments'), files=msg.get('files'))
-                val = '[%s/%s] (%s) %s: %s' % (ui.team_name(self), ui.channel_name(self, chanid), ts, ui.user_name(self, userid), text)
-                self.print(val)
+                val = '%s (%s) %s: %s' % (prefix, ts, ui.user_name(self, userid), text)
+                lines.append(val)
+            if lines:
+                self.print('\n'.join(lines))
             cursor = get_next_cursor(res)
             if not cursor:
                 break
@@ -784,12 +844,27 @@ class SlackTeam(Host):
 
         self.client.print('Fetching user information for %s' % (self.team_name,))
 
-        self.muted_channels.clear()
+        self.muted_channels = frozenset()
+        self.muted_needles = ()
         self.channels.clear()
         self.channels_by_name.clear()
+        self.channels_by_tail = {}
         self.users.clear()
         self.users_by_display_name.clear();
-    
+
+        # The prefs, the user list, and the channel list don't depend
+        # on each other, so we fetch them concurrently. The IM channels
+        # refer to users, so they have to wait for the user list.
+        await asyncio.gather(self.load_muted_channels(), self.load_users(), self.load_channels())
+        await self.load_im_channels()
+
+        self.index_channels()
+
+        #self.client.print('Channels for %s: %s' % (self, self.channels,))
+
+    async def load_muted_channels(self):
+        """Load the muted_channels list. (Part of load_connection_data.)
+        """
         # The muted_channels information is stored in your Slack preferences,
         # which are an undocumented (but I guess widely used) API call.
         # See: https://github.com/ErikKalkoken/slackApiDoc
@@ -798,29 +873,38 @@ class SlackTeam(Host):
             prefs = res.get('prefs')
             mutels = prefs.get('muted_channels')
             if mutels:
-                self.muted_channels = set(mutels.split(','))
+                self.muted_channels = frozenset(mutels.split(','))
+                self.muted_needles = tuple([ '"channel":"%s"' % (chanid,) for chanid in self.muted_channels ])
 
-        # Fetch user lists
+    async def load_users(self):
+        """Load the user list. (Part of load_connection_data.)
+        """
         cursor = None
         while True:
             res = await self.api_call_check('users.list', cursor=cursor)
             if not res:
                 break
+            users = self.users
+            users_by_display_name = self.users_by_display_name
             for user in res.get('members'):
                 userid = user['id']
-                username = user['profile']['display_name']
+                profile = user['profile']
+                username = profile['display_name']
                 if not username:
                     username = user['name']    # legacy data field
-                userrealname = user['profile']['real_name']
-                self.users[userid] = SlackUser(self, userid, username, userrealname)
-                self.users_by_display_name[username] = self.users[userid]
+                userobj = SlackUser(self, userid, username, profile['real_name'])
+                users[userid] = userobj
+                users_by_display_name[username] = userobj
             cursor = get_next_cursor(res)
             if not cursor:
                 break
             
         #self.client.print('Users for %s: %s' % (self, self.users,))
-    
-        # Fetch public and private channels
+
+    async def load_channels(self):
+        """Load the public and private channel lists. (Part of
+        load_connection_data.)
+        """
         cursor = None
         while True:
             res = await self.api_call_check('conversations.list', exclude_archived=True, types='public_channel,private_channel', cursor=cursor)
@@ -831,13 +915,17 @@ class SlackTeam(Host):
                 channame = chan['name']
                 priv = chan['is_private']
                 member = chan['is_member']
-                self.channels[chanid] = SlackChannel(self, chanid, channame, private=priv, member=member)
-                self.channels_by_name[channame] = self.channels[chanid]
+                chanobj = SlackChannel(self, chanid, channame, private=priv, member=member)
+                self.channels[chanid] = chanobj
+                self.channels_by_name[channame] = chanobj
             cursor = get_next_cursor(res)
             if not cursor:
                 break
-            
-        # Fetch IM (person-to-person) channels
+
+    async def load_im_channels(self):
+        """Load the IM (person-to-person) channel list. This must happen
+        after load_users(). (Part of load_connection_data.)
+        """
         cursor = None
         while True:
             res = await self.api_call_check('conversations.list', exclude_archived=True, types='im', cursor=cursor)
@@ -846,20 +934,21 @@ class SlackTeam(Host):
             for chan in res.get('channels'):
                 chanid = chan['id']
                 chanuser = chan['user']
-                if chanuser in self.users:
-                    self.users[chanuser].im_channel = chanid
-                    channame = '@'+self.users[chanuser].name
+                user = self.users.get(chanuser)
+                if user is not None:
+                    user.im_channel = chanid
+                    channame = '@'+user.name
                     self.channels[chanid] = SlackChannel(self, chanid, channame, private=True, member=True, im=chanuser)
                     # But not channels_by_name.
             cursor = get_next_cursor(res)
             if not cursor:
                 break
 
-        #self.client.print('Channels for %s: %s' % (self, self.channels,))
-
 class SlackChannel(Channel):
     """Simple object representing one channel in a group.
     """
+    __slots__ = ('nameparselist',)
+    
     def __init__(self, team, id, name, private=False, member=True, im=None):
         self.team = team
         self.client = team.client
@@ -886,6 +975,8 @@ class SlackChannel(Channel):
 class SlackUser(User):
     """Simple object representing one user in a group.
     """
+    __slots__ = ()
+    
     def __init__(self, team, id, name, real_name):
         self.team = team
         self.client = team.client
@@ -1,11 +1,25 @@
-from collections import OrderedDict
 import tempfile
 import os.path
 import urllib.parse
 import subprocess
-import aiohttp
-import aiohttp.web
 import asyncio
+import json
+
+# Use orjson if it's available. (It's considerably faster than the json
+# module.) The protocols parse websocket frames, web API responses, and
+# Mattermost's embedded post payloads with these; the client uses them
+# for the token file.
+try:
+    import orjson
+    json_loads = orjson.loads
+    def json_dumps(obj, indent=False):
+        if indent:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        return orjson.dumps(obj).decode()
+except ImportError:
+    json_loads = json.loads
+    def json_dumps(obj, indent=False):
+        return json.dumps(obj, indent=(2 if indent else None))
 
 from .parsematch import ParseMatch, NeverMatch
 
@@ -22,14 +36,14 @@ class Protocol:
 
     def __init__(self, client):
         self.client = client
-        self.teams = OrderedDict()   # team.key to Host
+        self.teams = {}   # team.key to Host
 
     def __repr__(self):
         return '<%s (%s)>' % (self.__class__.__name__, self.key,)
 
     def create_team(self, map):
         """Create a team and add it to the team list(s). The argument
-        is an OrderedDict of information.
+        is a dict of information.
         """
         # Call the HostClass's constructor.
         cla = self.hostclass
@@ -40,6 +54,7 @@ class Protocol:
         # Add it to both our team list and the master team list.
         self.teams[team.key] = team
         self.client.teams[team.key] = team
+        self.client.index_teams()
         
         return team
 
@@ -83,6 +98,9 @@ class Protocol:
         (This is generic to all OAuth implementation, so it lives in
         Protocol.)
         """
+        # Only needed during authentication, so we don't import it at
+        # startup.
+        import aiohttp.web
         
         async def handler(request):
             map = request.query
@@ -175,12 +193,17 @@ class Host:
     
     protocol = None
     protocolkey = None
+
+    # Cached result of short_name(); None means not yet computed.
+    short_name_cache = None
     
     # self.id: identifier, unique within protocol
     # self.key: "protocol:id"
     # self.users: map
     # self.channels: map
-    # self.origmap: the OrderedDict that was used to construct the Host
+    # self.channels_by_tail: map from lowercased channel name (last
+    #   segment) to channel; see index_channels()
+    # self.origmap: the dict that was used to construct the Host
     
     # self.nameparser: ParseMatch for the id and aliases
 
@@ -244,6 +267,24 @@ class Host:
         """
         raise NotImplementedError('load_connection_data')
 
+    def index_channels(self):
+        """Rebuild self.channels_by_tail, which lets the UI find an exact
+        channel name without scanning every channel. Call this after
+        self.channels is loaded.
+        If two channels share a name, the first one wins. (This matches
+        what ParseMatch.list_best() would pick.)
+        """
+        index = {}
+        for chan in self.channels.values():
+            par = chan.name_parsers()[-1]
+            if isinstance(par, NeverMatch):
+                continue
+            index.setdefault(par.id, chan)
+            if par.aliases:
+                for val in par.aliases:
+                    index.setdefault(val, chan)
+        self.channels_by_tail = index
+
     def get_aliases(self):
         """Return a list of team aliases or None.
         """
@@ -256,7 +297,9 @@ class Host:
         """Set a list of team aliases.
         """
         self.client.prefs.team_put('aliases', aliases, self)
+        self.short_name_cache = None
         self.update_name_parser()
+        self.client.index_teams()
 
     def update_name_parser(self):
         """Update the matcher for this host's name, accepting current
@@ -266,11 +309,16 @@ class Host:
         
     def short_name(self):
         """Return the team name or the first alias.
+        (This appears in every displayed message, so we cache it.
+        set_aliases() clears the cache.)
         """
-        ls = self.client.prefs.team_get('aliases', self)
-        if ls:
-            return ls[0]
-        return self.team_name
+        if self.short_name_cache is None:
+            ls = self.client.prefs.team_get('aliases', self)
+            if ls:
+                self.short_name_cache = ls[0]
+            else:
+                self.short_name_cache = self.team_name
+        return self.short_name_cache
 
     def set_last_channel(self, chanid):
         """Note the last channel used for this team.
@@ -306,6 +354,11 @@ class Host:
 class Channel:
     """Represents a discussion channel on a Host.
     """
+    # Hosts can have thousands of channels, so we use slots rather than
+    # a per-instance dict. Subclasses must declare any further fields
+    # in their own __slots__.
+    __slots__ = ('team', 'id', 'name', 'client', 'private', 'imuser', 'member')
+    
     # self.team
     # self.id
     # self.name
@@ -342,6 +395,9 @@ class Channel:
 class User:
     """Represents a user at a Host.
     """
+    # As with Channel, we use slots to keep these small.
+    __slots__ = ('team', 'id', 'name', 'real_name', 'client', 'im_channel')
+    
     # self.team
     # self.id
     # self.name
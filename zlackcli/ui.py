@@ -2,16 +2,16 @@ import re
 import time
 import os.path
 import urllib.parse
+from operator import attrgetter
 
-pat_special_command = re.compile('/([a-z0-9?_-]+)', flags=re.IGNORECASE)
-pat_dest_command = re.compile('#([^ ]+)')
+# An input line may begin with a /command (group 1) or a #channel
+# prefix (group 2). We check both with one match.
+pat_input_prefix = re.compile('/([a-zA-Z0-9?_-]+)|#([^ ]+)')
 
 pat_integer = re.compile('[0-9]+')
 pat_url = re.compile('http[s]?:.*', flags=re.IGNORECASE)
 
-pat_channel_command = re.compile('^(?:([a-z0-9_-]+)[/:])?([a-z0-9_-]+)$', flags=re.IGNORECASE)
-pat_im_command = re.compile('^(?:([a-z0-9_-]+)[/:])?@([a-z0-9._]+)$', flags=re.IGNORECASE)
-pat_defaultchan_command = re.compile('^([a-z0-9_-]+)[/:]$', flags=re.IGNORECASE)
+pat_interval = re.compile('^([0-9]+)([a-zA-Z]*)$')
 
 class ArgException(Exception):
     """ArgException: Raised whenever a user command doesn't conform to the
@@ -67,6 +67,9 @@ class UI:
         self.lastchannel = None
         # The last channel seen when the user started typing.
         self.presumedchannel = None
+        # (now, (year, yday)) for short_timestamp(), so that a recap
+        # doesn't call localtime() for the current time on every line.
+        self.today_cache = (None, None)
         
         self.debug_messages = False
         if opts and opts.debug_messages:
@@ -157,8 +160,12 @@ class UI:
     def handle_input(self, val):
         """Handle one input line from the player.
         """
-        match = pat_special_command.match(val)
-        if match:
+        # Most lines are plain messages; only try the prefix regex if
+        # the line could possibly match it.
+        match = None
+        if val.startswith(('/', '#')):
+            match = pat_input_prefix.match(val)
+        if match and match.group(1):
             cmd = match.group(1).lower()
             args = val[ match.end() : ].split()
             han = self.handler_map.get(cmd)
@@ -184,10 +191,9 @@ class UI:
                 task.add_done_callback(callback)
             return
 
-        match = pat_dest_command.match(val)
         if match:
             # The line starts with a channel prefix.
-            cmd = match.group(1)
+            cmd = match.group(2)
             val = val[ match.end() : ].lstrip()
 
             try:
@@ -237,8 +243,11 @@ class UI:
         """
         tup = time.localtime(float(ts))
         # If the timestamp is from today, we use a shorter form.
-        nowtup = time.localtime()
-        if tup.tm_year == nowtup.tm_year and tup.tm_yday == nowtup.tm_yday:
+        now = int(time.time())
+        if now != self.today_cache[0]:
+            nowtup = time.localtime(now)
+            self.today_cache = (now, (nowtup.tm_year, nowtup.tm_yday))
+        if (tup.tm_year, tup.tm_yday) == self.today_cache[1]:
             val = time.strftime('%H:%M', tup)
         else:
             val = time.strftime('%m/%d %H:%M', tup)
@@ -251,13 +260,11 @@ class UI:
         if team is None:
             return '<no team>'
         if not isinstance(team, Host):
-            if team not in self.client.teams:
-                return '???%s' % (team,)
-            team = self.client.teams[team]
-        aliases = team.get_aliases()
-        if aliases:
-            return aliases[0]
-        return team.team_name
+            teamkey = team
+            team = self.client.teams.get(teamkey)
+            if team is None:
+                return '???%s' % (teamkey,)
+        return team.short_name()
     
     def channel_name(self, team, chanid):
         """Look up a channel name.
@@ -266,23 +273,34 @@ class UI:
         isn't loaded.)
         """
         if not isinstance(team, Host):
-            if team not in self.client.teams:
+            team = self.client.teams.get(team)
+            if team is None:
                 return '???%s' % (chanid,)
-            team = self.client.teams[team]
-        if chanid not in team.channels:
+        chan = team.channels.get(chanid)
+        if chan is None:
             return '???%s' % (chanid,)
-        return team.channels[chanid].display_name()
+        return chan.display_name()
+    
+    def channel_prefix(self, team, chanid):
+        """Return the "[team/channel]" label which begins every displayed
+        message.
+        """
+        if team is not None and not isinstance(team, Host):
+            # Resolve the key once, rather than in both calls below.
+            team = self.client.teams.get(team, team)
+        return '[%s/%s]' % (self.team_name(team), self.channel_name(team, chanid))
     
     def user_name(self, team, userid):
         """Look up a user name (the displayname).
         """
         if not isinstance(team, Host):
-            if team not in self.client.teams:
+            team = self.client.teams.get(team)
+            if team is None:
                 return userid
-            team = self.client.teams[team]
-        if userid not in team.users:
+        user = team.users.get(userid)
+        if user is None:
             return userid
-        return team.users[userid].display_name()
+        return user.display_name()
 
     def parse_channelspec(self, val):
         """Parse a channel specification, in any of its various forms:
@@ -328,9 +346,10 @@ class UI:
             else:
                 team = self.parse_team(valls[0])
                 
-            if username not in team.users_by_display_name:
+            user = team.users_by_display_name.get(username)
+            if user is None:
                 raise ArgException('User not recognized: %s' % (username,))
-            chanid = team.users_by_display_name[username].im_channel
+            chanid = user.im_channel
             if not chanid:
                 raise ArgException('No IM channel with user: %s' % (username,))
             return (team, chanid)
@@ -339,8 +358,12 @@ class UI:
             # Simple search: TEAM or CHANNEL.
             val = valls[0]
             
-            # For curteam, check the tail of all channels.
+            # For curteam, check the tail of all channels. (Exact matches
+            # are a single dict lookup.)
             if curteam:
+                chan = curteam.channels_by_tail.get(val)
+                if chan:
+                    return (curteam, chan.id)
                 resls = []
                 for (id, chan) in curteam.channels.items():
                     res = chan.name_parsers()[-1](val)
@@ -350,7 +373,12 @@ class UI:
                 if tup:
                     return tup
 
-            # For all teams, check the tail of all channels.
+            # For all teams, check the tail of all channels. Again, try
+            # exact matches first.
+            for team in allteams:
+                chan = team.channels_by_tail.get(val)
+                if chan:
+                    return (team, chan.id)
             resls = []
             for team in allteams:
                 for (id, chan) in team.channels.items():
@@ -468,6 +496,10 @@ class UI:
         Raises ArgException if not recognized.
         """
         val = val.lower()
+        # Exact matches are a single dict lookup.
+        team = self.client.teams_by_name.get(val)
+        if team:
+            return team
         ls = [ (team.name_parser()(val), team) for team in self.client.teams.values() ]
         team = ParseMatch.list_best(ls)
         if team:
@@ -478,7 +510,6 @@ class UI:
         """Convert a string to a number of seconds. This accepts values like
         "5" (default minutes), "10m", "2h", "1d".
         """
-        pat_interval = re.compile('^([0-9]+)([a-z]*)$', flags=re.IGNORECASE)
         match = pat_interval.match(val)
         if not match:
             raise ArgException('Interval not recognized: %s' % (val,))
@@ -615,12 +646,12 @@ class UI:
         if args:
             raise ArgException('Expected no arguments')
         livecount = len([ pro for pro in self.client.protocols if pro.teams ])
+        # Collect the lines and print them all at once.
+        lines = []
         for pro in self.client.protocols:
             if livecount > 1:
-                print('%s:' % (pro.key,))
-            ls = list(pro.teams.values())
-            ls.sort(key = lambda team:team.team_name)
-            for team in ls:
+                lines.append('%s:' % (pro.key,))
+            for team in sorted(pro.teams.values(), key=attrgetter('team_name')):
                 teamname = team.team_name
                 memflag = ('*' if team.rtm_connected() else ' ')
                 idstring = (' (id %s)' % (team.id,) if self.debug_messages else '')
@@ -630,7 +661,9 @@ class UI:
                     aliasstr = ' (%s)' % (aliases,)
                 else:
                     aliasstr = ''
-                self.print(' %s%s%s%s' % (memflag, teamname, idstring, aliasstr))
+                lines.append(' %s%s%s%s' % (memflag, teamname, idstring, aliasstr))
+        if lines:
+            self.print('\n'.join(lines))
     
     @uicommand('users',
                arghelp='[team]',
@@ -639,11 +672,12 @@ class UI:
         """Command: display the list of users.
         """
         team = self.parse_team_or_current(args)
-        ls = list(team.users.values())
-        ls.sort(key = lambda user:user.name)
-        for user in ls:
+        lines = []
+        for user in sorted(team.users.values(), key=attrgetter('name')):
             idstring = (' (id %s)' % (user.id,) if self.debug_messages else '')
-            self.print('  %s%s: %s' % (user.display_name(), idstring, user.real_name))
+            lines.append('  %s%s: %s' % (user.display_name(), idstring, user.real_name))
+        if lines:
+            self.print('\n'.join(lines))
     
     @uicommand('channels',
                arghelp='[team]',
@@ -653,15 +687,17 @@ class UI:
         that we are members of. Muted and private channels are also flagged.
         """
         team = self.parse_team_or_current(args)
-        ls = list(team.channels.values())
-        ls = [ chan for chan in ls if not chan.imuser ]
+        ls = [ chan for chan in team.channels.values() if not chan.imuser ]
         ls.sort(key=lambda chan:(not chan.member, chan.muted(), chan.name))
+        lines = []
         for chan in ls:
             idstring = (' (id %s)' % (chan.id,) if self.debug_messages else '')
             memflag = ('*' if chan.member else ' ')
             privflag = (' (priv)' if chan.private else '')
             muteflag = (' (mute)' if chan.muted() else '')
-            self.print(' %s%s%s%s%s' % (memflag, chan.display_name(), idstring, privflag, muteflag))
+            lines.append(' %s%s%s%s%s' % (memflag, chan.display_name(), idstring, privflag, muteflag))
+        if lines:
+            self.print('\n'.join(lines))
 
     @uicommand('reload', isasync=True,
                arghelp='[team]',